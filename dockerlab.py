@@ -10,19 +10,22 @@ try:
 except ImportError:
     from yaml import Loader, Dumper
 from colorama import Fore, Back
-from typing import TypedDict, Optional
+from typing import TypedDict, Optional, TextIO
 from ipaddress import ip_address, ip_network, IPv4Address, IPv4Network
 import copy
 import argparse
 import subprocess
 import shlex
 from pynput import keyboard
-from threading import Thread
+from threading import Thread, Lock, get_ident
 import re
 import PySimpleGUI as sg
 import time
 import json
 import psutil
+import os
+import atexit
+from contextlib import contextmanager
 
 
 ###############################
@@ -33,6 +36,7 @@ class Arguments(TypedDict):
     execute:bool
     monitor:bool
     usage:bool
+    trace:Optional[str]
 
 class Compose (TypedDict):
     version:str
@@ -80,6 +84,10 @@ class Docker_Network(TypedDict):
 tshark_process:subprocess.Popen = None
 continue_monitor:bool           = True
 compose_name:str = ""
+trace_events:list[dict]         = None  # None -> trazado desactivado
+trace_lock:Lock                 = Lock()
+trace_origin:float              = 0.0
+trace_processes:dict            = {}    # Popen -> (orden, instante de inicio)
 
 ###############################
 #  DEFINICIÓN DE EXCEPCIONES  #
@@ -97,6 +105,171 @@ class IpAddrException(Exception):
         super().__init__(*args)
         
 
+###############################
+#     FUNCIONES DE TRAZADO    #
+###############################
+
+def start_trace() -> None:
+    """
+    Función "start_trace", que activa el trazado de fases y subprocesos. Mientras no se
+    llame a esta función, el resto de funciones de trazado no realizan ningún trabajo.
+    """
+    global trace_events, trace_origin
+    trace_events = []
+    trace_origin = time.perf_counter()
+
+
+def add_trace_event(name:str, category:str, start:float, end:float, args:Optional[dict]=None,
+                    tid:Optional[int]=None) -> None:
+    """
+    Función "add_trace_event", que añade a la traza un evento completo (fase "X" del formato
+    Chrome trace-event) a partir de sus instantes de inicio y fin según 'time.perf_counter()'.
+    Si no se indica 'tid', el evento se dibuja en la línea del hilo que lo registra.
+    """
+    if trace_events is None: return
+    event:dict = {"name":name, "cat":category, "ph":"X",
+                  "ts":round((start-trace_origin)*1e6), "dur":round((end-start)*1e6),
+                  "pid":os.getpid(), "tid":tid if tid is not None else get_ident(),
+                  "args":args if args is not None else {}}
+    with trace_lock:
+        trace_events.append(event)
+
+
+@contextmanager
+def trace_phase(name:str, **args):
+    """
+    Gestor de contexto "trace_phase", que registra como un tramo de la traza la duración
+    del bloque que envuelve. Si el bloque lanza una excepción, se anota en el tramo.
+    """
+    if trace_events is None:
+        yield
+        return
+    start:float = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        add_trace_event(name, "phase", start, time.perf_counter(), args)
+
+
+def trace_popen(command:str, *args, **kwargs) -> subprocess.Popen:
+    """
+    Función "trace_popen", que lanza la orden 'command' mediante 'subprocess.Popen'. Si el
+    trazado está activo, guarda en 'trace_processes' la orden y su instante de inicio para
+    que 'trace_process_end' pueda registrar su duración y código de retorno.
+    """
+    proc:subprocess.Popen = subprocess.Popen(shlex.split(command), *args, **kwargs)
+    if trace_events is not None:
+        with trace_lock:
+            trace_processes[proc] = (command, time.perf_counter())
+    return proc
+
+
+def trace_process_end(proc:subprocess.Popen) -> None:
+    """
+    Función "trace_process_end", que registra en la traza un subproceso lanzado con
+    'trace_popen' una vez ha finalizado, junto con la orden ejecutada y su código de retorno.
+    El nombre del tramo se forma con las primeras palabras de la orden (p. ej. "docker network inspect")
+    y se dibuja en una línea propia identificada por el PID del subproceso, ya que varios subprocesos
+    (p. ej. 'docker stats') pueden solaparse y finalizar en hilos distintos al que los lanzó.
+    """
+    if trace_events is None: return
+    with trace_lock:
+        entry:Optional[tuple] = trace_processes.pop(proc, None)
+    if entry is None: return
+    (command, start) = entry
+    return_code:int = proc.wait()
+    end:float = time.perf_counter()
+    name:list[str] = []
+    for word in shlex.split(command)[:3]:
+        if word.startswith("-"): break
+        name.append(word)
+    add_trace_event(" ".join(name), "subprocess", start, end,
+                    {"command":command, "returncode":return_code}, tid=proc.pid)
+
+
+def compose_project_name() -> str:
+    """
+    Función "compose_project_name", que devuelve el nombre de proyecto que asigna docker-compose
+    a los contenedores: 'COMPOSE_PROJECT_NAME' o, en su defecto, el nombre del directorio actual normalizado.
+    """
+    name:str = os.environ.get("COMPOSE_PROJECT_NAME") or os.path.basename(os.getcwd())
+    return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+
+def trace_first_container(process_compose:subprocess.Popen) -> None:
+    """
+    Función "trace_first_container", que escucha los eventos de arranque de contenedores del
+    proyecto mediante un único 'docker events' y registra en la traza el tiempo transcurrido
+    desde el inicio de 'docker-compose up' hasta que arranca el primer contenedor. Sólo se tienen
+    en cuenta eventos posteriores al inicio de 'up', por lo que no cuentan contenedores de
+    ejecuciones anteriores.
+    """
+    if trace_events is None: return
+    with trace_lock:
+        entry:Optional[tuple] = trace_processes.get(process_compose)
+    if entry is None: return
+    start:float = entry[1]
+    # Instante de inicio de 'up' en tiempo de reloj, necesario para filtrar con '--since'
+    since:float = time.time() - (time.perf_counter() - start)
+    events:subprocess.Popen = subprocess.Popen(shlex.split("docker events --filter type=container --filter event=start "+
+                                                           f"--filter label=com.docker.compose.project={compose_project_name()} "+
+                                                           f"--since {since:.6f} --format '{{{{.TimeNano}}}} {{{{.Actor.Attributes.name}}}}'"),
+                                               stdout=subprocess.PIPE,
+                                               stderr=subprocess.DEVNULL,
+                                               universal_newlines=True)
+
+    def close_events() -> None:
+        # Si 'up' termina sin llegar a arrancar ningún contenedor, se cierra el flujo de eventos
+        process_compose.wait()
+        events.kill()
+    Thread(target=close_events, daemon=True).start()
+
+    line:str = events.stdout.readline()
+    events.kill()
+    events.wait()
+    if line.strip():
+        time_nano, container = line.split(maxsplit=1)
+        end:float = start + (int(time_nano)/1e9 - since)
+        add_trace_event("first container running", "phase", start, end,
+                        {"container":container.strip()}, tid=process_compose.pid)
+
+
+def write_trace(trace_file:TextIO) -> None:
+    """
+    Función "write_trace", que guarda los eventos registrados en 'trace_file' (abierto al
+    inicio de la ejecución) en formato Chrome trace-event (visualizable en chrome://tracing
+    o Perfetto) y muestra por pantalla una tabla resumen con el tiempo acumulado por tramo.
+    """
+    if trace_events is None: return
+    with trace_lock:
+        events:list[dict] = sorted(trace_events, key=lambda e: e["ts"])
+    try:
+        with trace_file:
+            json.dump({"traceEvents":events, "displayTimeUnit":"ms"}, trace_file, indent=1)
+        print(f"{Fore.GREEN}Traza guardada en '{trace_file.name}'.{Fore.RESET}")
+    except OSError as e:
+        print(f"{Fore.RED}No se ha podido guardar la traza en '{trace_file.name}': \n\t{e}{Fore.RESET}")
+
+    summary:dict = {}
+    for event in events:
+        row:dict = summary.setdefault(event["name"], {"count":0, "total":0, "max":0, "codes":set()})
+        row["count"] += 1
+        row["total"] += event["dur"]
+        row["max"] = max(row["max"], event["dur"])
+        if "returncode" in event["args"]: row["codes"].add(event["args"]["returncode"])
+        if "error" in event["args"]: row["codes"].add("error")
+
+    print(f"{Fore.GREEN}Resumen de la traza:{Fore.RESET}")
+    width:int = max([len(name) for name in summary] + [len("Tramo")])
+    print(f"{'Tramo':<{width}}  {'Llamadas':>8}  {'Total (ms)':>11}  {'Máx (ms)':>10}  Códigos de retorno")
+    for name, row in sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True):
+        codes:str = ", ".join(str(c) for c in sorted(row["codes"], key=str)) or "-"
+        print(f"{name:<{width}}  {row['count']:>8}  {row['total']/1000:>11.1f}  {row['max']/1000:>10.1f}  {codes}")
+
+
 ###############################
 #   DEFINICIÓN DE FUNCIONES   #
 ###############################
@@ -149,7 +322,7 @@ def list_networks(is_debugging=False, *args, **conf) -> list[Docker_Network_List
     """
     network_list:list[Docker_Network_List] = []
     header:bool = True
-    with subprocess.Popen(shlex.split("docker network list"),
+    with trace_popen("docker network list",
                                     stdout=subprocess.PIPE,
                                     universal_newlines=True) as p:
         for line in p.stdout:
@@ -165,6 +338,7 @@ def list_networks(is_debugging=False, *args, **conf) -> list[Docker_Network_List
 
         if is_debugging: 
             print(f"{Fore.BLUE}Código de retorno (Network listing): {p.wait()}{Fore.RESET}")
+    trace_process_end(p)
     return network_list
 
 
@@ -175,11 +349,12 @@ def get_network_data(docker_network:Docker_Network_List, is_debugging:bool=False
     """
     result:Docker_Network=None
     if is_debugging: print(f"{Fore.BLUE}Ejecutando 'docker network inspect {docker_network['name']}'...{Fore.RESET}")
-    with subprocess.Popen(shlex.split(f"docker network inspect {docker_network['name']}"),
+    with trace_popen(f"docker network inspect {docker_network['name']}",
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE,
                                     universal_newlines=True) as p:
         stdout, stderr = p.communicate()
+    trace_process_end(p)
     # Verifica si hubo errores en la salida estándar
     if p.returncode == 0:
         # Intenta parsear la salida como JSON
@@ -202,12 +377,12 @@ def create_network(network:IPv4Network,name:str, *args, **conf) -> bool:
     """
     network_created:bool = True
 
-    with subprocess.Popen(shlex.split("docker network create --driver=bridge "+
+    with trace_popen("docker network create --driver=bridge "+
                                       "--opt com.docker.network.bridge.name=br-dockerlab "+
                                       "--opt com.docker.network.bridge.enable_icc=true "+
                                       "--opt com.docker.network.bridge.enable_ip_masquerade=true "+
                                       "--opt com.docker.network.bridge.host_binding_ipv4=0.0.0.0 "+
-                                      f"--subnet {network} {name}"),
+                                      f"--subnet {network} {name}",
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 universal_newlines=True) as p:
@@ -219,6 +394,7 @@ def create_network(network:IPv4Network,name:str, *args, **conf) -> bool:
 
         if "debug" in conf and conf["debug"]:
             print(f"Código de retorno (Network creation): {p.wait()}")  
+    trace_process_end(p)
     return network_created
 
 
@@ -238,24 +414,26 @@ def generate_network(network:IPv4Network, compose:Compose, *args, **conf) -> Non
         if "debug" in conf and conf["debug"]: 
             print(f"{Fore.BLUE}network, name = {network}, {name}{Fore.RESET}")
             is_debugging=True
-        for i in list_networks(is_debugging):
-            if "debug" in conf and conf["debug"]: print(f"{Fore.BLUE}i (list_networks)={i}{Fore.RESET}")
-            docker_network:Docker_Network=get_network_data(i, is_debugging)
-            if "debug" in conf and conf["debug"]: print(f"{Fore.BLUE}docker_network={docker_network}{Fore.RESET}")
-            if ((docker_network["Name"] not in {"none", "host", "bridge"} and
-                    len(docker_network["IPAM"]["Config"])>0 and                    
-                    "Subnet" in docker_network["IPAM"]["Config"][0] and            
-                    (ip_network(docker_network["IPAM"]["Config"][0]["Subnet"]).subnet_of(network) or
-                     ip_network(docker_network["IPAM"]["Config"][0]["Subnet"]).supernet_of(network))) or 
-                     docker_network["Name"]==name):
-                with subprocess.Popen(shlex.split(f"docker network remove {docker_network['Name']}"),
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    universal_newlines=True) as p:
-                    for err in p.stderr:
-                        print(f"{Fore.RED}{err}{Fore.RESET}", end='')
-                if "debug" in conf and conf["debug"]: 
-                    print(f"Código de retorno (Network removal): {p.wait()}")
+        with trace_phase("network cleanup", network=f"{network}"):
+            for i in list_networks(is_debugging):
+                if "debug" in conf and conf["debug"]: print(f"{Fore.BLUE}i (list_networks)={i}{Fore.RESET}")
+                docker_network:Docker_Network=get_network_data(i, is_debugging)
+                if "debug" in conf and conf["debug"]: print(f"{Fore.BLUE}docker_network={docker_network}{Fore.RESET}")
+                if ((docker_network["Name"] not in {"none", "host", "bridge"} and
+                        len(docker_network["IPAM"]["Config"])>0 and                    
+                        "Subnet" in docker_network["IPAM"]["Config"][0] and            
+                        (ip_network(docker_network["IPAM"]["Config"][0]["Subnet"]).subnet_of(network) or
+                         ip_network(docker_network["IPAM"]["Config"][0]["Subnet"]).supernet_of(network))) or 
+                         docker_network["Name"]==name):
+                    with trace_popen(f"docker network remove {docker_network['Name']}",
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        universal_newlines=True) as p:
+                        for err in p.stderr:
+                            print(f"{Fore.RED}{err}{Fore.RESET}", end='')
+                    if "debug" in conf and conf["debug"]: 
+                        print(f"Código de retorno (Network removal): {p.wait()}")
+                    trace_process_end(p)
 
         create_network(network, name)
 
@@ -408,12 +586,13 @@ def read_output(proc) -> None:
         print(line, end='')
     # espera a que el subproceso termine y obtiene su código de retorno
     return_code = proc.wait()
+    trace_process_end(proc)
     # imprime el código de retorno del subproceso
     print(f"Código de retorno (read output): {return_code}")
 
 
 def stop_compose() -> None:
-    with subprocess.Popen(shlex.split("docker-compose stop"),
+    with trace_popen("docker-compose stop",
                                         stdout=subprocess.PIPE,
                                         universal_newlines=True) as p:
         t = Thread(target=read_output, args=(p,))
@@ -452,6 +631,7 @@ def read_monitor_output(proc:subprocess.Popen, content:list[list]) -> None:
             content[i]=["-","-","-","-","-","-","-","-"]
 
     return_code = proc.wait()
+    trace_process_end(proc)
     # imprime el código de retorno del subproceso en caso de error
     if return_code != 0:
         print(f"Proceso 'read_monitor_output' finalizado con código: {Fore.RED}{return_code}{Fore.RESET}")
@@ -465,7 +645,7 @@ def itera_monitor_output(content:list[list]) -> None:
     con las estadísticas de los contenedores actualmente en ejecución en el equipo cada segundo.
     """
     while(continue_monitor):
-        process:subprocess.Popen = subprocess.Popen(shlex.split('docker stats --no-trunc --no-stream --format "table {{.ID}}\t{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.MemPerc}}\t{{.NetIO}}\t{{.BlockIO}}\t{{.PIDs}}"'),
+        process:subprocess.Popen = trace_popen('docker stats --no-trunc --no-stream --format "table {{.ID}}\t{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.MemPerc}}\t{{.NetIO}}\t{{.BlockIO}}\t{{.PIDs}}"',
                                                 stdout=subprocess.PIPE,
                                                 universal_newlines=True)
         Thread(target=read_monitor_output, args=(process, content, )).start()
@@ -532,7 +712,7 @@ def monitoriza_red(network:IPv4Network) -> None:
     
     if if_name is not None:
         print(f"{Fore.GREEN}Comienza la monitorización!{Fore.RESET}")
-        tshark_process = subprocess.Popen(shlex.split(f"tshark -i {if_name} -w output.pcap"), stdout=subprocess.PIPE, universal_newlines=True) 
+        tshark_process = trace_popen(f"tshark -i {if_name} -w output.pcap", stdout=subprocess.PIPE, universal_newlines=True) 
     
 
 
@@ -540,6 +720,17 @@ def monitoriza_red(network:IPv4Network) -> None:
 #      SCRIPT PRINCIPAL       #
 ###############################
 def dockerlab(debug:bool=False,flags:Arguments={"build":True, "execute":True, "monitor":False, "execute":False}) -> None:
+    # Trazado de fases: la traza se escribe al salir, una vez terminados los hilos pendientes
+    # Se abre el archivo al inicio para no perder la traza si la ruta no es válida
+    if flags.get("trace"):
+        try:
+            trace_file:TextIO = open(flags["trace"], "w")
+        except OSError as e:
+            print(f"{Fore.RED}No se puede abrir el archivo de traza, se continúa sin trazado: \n\t{e}{Fore.RESET}")
+        else:
+            start_trace()
+            atexit.register(write_trace, trace_file)
+
     #Caso por defecto
     if not(flags["build"]) and not(flags["execute"]) and not(flags["monitor"]) and not(flags["execute"]):
         flags["build"] = True
@@ -548,17 +739,22 @@ def dockerlab(debug:bool=False,flags:Arguments={"build":True, "execute":True, "m
     if flags["build"]:
         file = open("./config.yml", "r")
         compose_file = open("./docker-compose.yml", "w")
-        config:dict = load (file, Loader=Loader)
+        with trace_phase("load config.yml"):
+            config:dict = load (file, Loader=Loader)
         compose:Compose = {}
         compose["version"]="3.3"
         try:
-            (network, nodes) = reader(config, compose, debug=debug)
+            with trace_phase("reader"):
+                (network, nodes) = reader(config, compose, debug=debug)
             print("Se ha leído config.yml correctamente")
             if debug: print(f"{Fore.BLUE}\tNetwork:\t{network}\n\tNodes:\t{nodes}{Fore.RESET}")
-            generate_network(network, compose, debug=debug)
+            with trace_phase("generate_network"):
+                generate_network(network, compose, debug=debug)
             print("Red implementada correctamente.")
-            parse_node(nodes, compose, network, debug=debug)
-            dump(compose, compose_file)
+            with trace_phase("parse_node", nodes=len(nodes)):
+                parse_node(nodes, compose, network, debug=debug)
+            with trace_phase("dump docker-compose.yml"):
+                dump(compose, compose_file)
             print(f"{Fore.GREEN}'docker-compose.yml' generado correctamente.{Fore.RESET}")
         except KeyError as e:
             print(f'{Fore.RED}KeyError: No existe el parámetro {e} en config.yml{Fore.RESET}')
@@ -575,12 +771,12 @@ def dockerlab(debug:bool=False,flags:Arguments={"build":True, "execute":True, "m
     if flags["execute"]:
         # Hacemos pull y build
         print(f"{Fore.GREEN}Haciendo pull a los contenedores...{Fore.RESET}")
-        read_output(subprocess.Popen(shlex.split("docker-compose pull"),
+        read_output(trace_popen("docker-compose pull",
                                     stdout=subprocess.PIPE,
                                     universal_newlines=True))
         print(f"{Fore.GREEN}¡Pull realizado correctamente!{Fore.RESET}")
         print(f"{Fore.GREEN}Construyendo contenedores...{Fore.RESET}")
-        read_output(subprocess.Popen(shlex.split("docker-compose build"),
+        read_output(trace_popen("docker-compose build",
                                     stdout=subprocess.PIPE,
                                     universal_newlines=True))
         print(f"{Fore.GREEN}¡Contenedores construidos satisfactoriamente!{Fore.RESET}")
@@ -618,12 +814,14 @@ def dockerlab(debug:bool=False,flags:Arguments={"build":True, "execute":True, "m
                     running = True
 
                     print("Creando subproceso docker-compose...")
-                    process_compose:subprocess.Popen = subprocess.Popen(shlex.split("docker-compose up --remove-orphans --force-recreate"),
+                    process_compose:subprocess.Popen = trace_popen("docker-compose up --remove-orphans --force-recreate",
                                                     stdout=subprocess.PIPE,
                                                     universal_newlines=True)
                     print(f"{Fore.GREEN}Subproceso creado correctamente!{Fore.RESET}")
                     t = Thread(target=read_output, args=(process_compose,))
                     t.start()
+                    if trace_events is not None:
+                        Thread(target=trace_first_container, args=(process_compose,), daemon=True).start()
                     
                     
                 elif f'{event.key}' == "'s'" and running:
@@ -637,6 +835,7 @@ def dockerlab(debug:bool=False,flags:Arguments={"build":True, "execute":True, "m
                         stop_compose()
                     if(flags["monitor"] and tshark_process is not None): 
                         tshark_process.kill()
+                        trace_process_end(tshark_process)
                     if(flags["usage"] and continue_monitor):
                         continue_monitor = False
                     break
@@ -654,5 +853,7 @@ if __name__=="__main__":
               ["-m", "--monitor",   "Monitoriza el tráfico de paquetes en la red simulada. Debe usarse junto con -e."],
               ["-u", "--usage",     "Monitoriza el uso de recursos dentro de los contenedores de la simulación. Debe usarse junto con -e."]]:
         parser.add_argument(i[0],i[1], action='store_true', help=i[2])
+    parser.add_argument("-t", "--trace", metavar="FILE", default=None,
+                        help="Guarda en FILE una traza (formato Chrome trace-event) con la duración de cada fase y de cada orden de Docker ejecutada, y muestra un resumen al finalizar.")
     flags:Arguments = vars(parser.parse_args())
     dockerlab(debug=False, flags=flags)
\ No newline at end of file